@@ -100,6 +100,9 @@ setup(
         'recommended': [
             'colorlog',
             'crick',
+            'imagecodecs',
+            'numba',
+            'orjson',
             'pymysql>=1.0.0'
         ]
     },
@@ -9,7 +9,7 @@ import sys
 import zlib
 
 import numpy as np
-from cachetools import LFUCache
+from cachetools import LFUCache, LRUCache
 
 CompressionTuple = Tuple[bytes, bytes, str, Tuple[int, int]]
 SizeFunction = Callable[[CompressionTuple], int]
@@ -57,3 +57,12 @@ class CompressedLFUCache(LFUCache):
     def _get_size(x: Tuple) -> int:
         sizes = map(sys.getsizeof, x)
         return sum(sizes)
+
+
+class ClosingLRUCache(LRUCache):
+    """Least-recently-used cache that closes values when they are evicted"""
+
+    def popitem(self) -> Tuple[Any, Any]:
+        key, value = super().popitem()
+        value.close()
+        return key, value
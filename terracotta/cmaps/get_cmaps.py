@@ -4,6 +4,7 @@ Define an interface to retrieve stored color maps.
 """
 
 from typing import Dict
+import functools
 import os
 from pkg_resources import resource_filename, Requirement, DistributionNotFound
 
@@ -66,6 +67,14 @@ def _read_cmap(path: str) -> np.ndarray:
     return cmap_data
 
 
+@functools.lru_cache(maxsize=None)
+def _load_cmap(path: str) -> np.ndarray:
+    cmap_data = _read_cmap(path)
+    # the same array is handed to every caller, so protect it from modification
+    cmap_data.flags.writeable = False
+    return cmap_data
+
+
 CMAP_FILES = _get_cmap_files()
 AVAILABLE_CMAPS = sorted(CMAP_FILES.keys())
 
@@ -79,4 +88,4 @@ def get_cmap(name: str) -> np.ndarray:
     if name not in AVAILABLE_CMAPS:
         raise ValueError(f'Unknown colormap {name}, must be one of {AVAILABLE_CMAPS}')
 
-    return _read_cmap(CMAP_FILES[name])
+    return _load_cmap(CMAP_FILES[name])
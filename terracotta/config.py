@@ -28,6 +28,9 @@ class TerracottaSettings(NamedTuple):
     #: Send performance traces to AWS X-Ray
     XRAY_PROFILE: bool = False
 
+    #: Directory to write cProfile stats of /kiyomasa requests to (disabled if not set)
+    CPROFILE_DIR: Optional[str] = None
+
     #: Default log level (debug, info, warning, error, critical)
     LOGLEVEL: str = 'warning'
 
@@ -46,6 +49,15 @@ class TerracottaSettings(NamedTuple):
     #: Compression level of output PNGs, from 0-9
     PNG_COMPRESS_LEVEL: int = 1
 
+    #: Compression level of /kiyomasa tile PNGs, from 0-9 (favors encoding speed over size)
+    PNG_COMPRESS_LEVEL_FAST: int = 1
+
+    #: Seconds that clients may reuse /kiyomasa tiles (Cache-Control max-age)
+    KIYOMASA_CACHE_MAX_AGE: int = 300
+
+    #: Maximum number of tiles that can be requested at once from /kiyomasa tile batches
+    KIYOMASA_MAX_BATCH_TILES: int = 64
+
     #: Timeout in seconds for database connections
     DB_CONNECTION_TIMEOUT: int = 10
 
@@ -84,6 +96,10 @@ def _is_writable(path: str) -> bool:
     return os.access(os.path.dirname(path) or os.getcwd(), os.W_OK)
 
 
+def _is_writable_dir(path: str) -> bool:
+    return os.path.isdir(path) and os.access(path, os.W_OK)
+
+
 class SettingSchema(Schema):
     """Schema used to create and validate TerracottaSettings objects"""
     DRIVER_PATH = fields.String()
@@ -92,6 +108,7 @@ class SettingSchema(Schema):
     DEBUG = fields.Boolean()
     FLASK_PROFILE = fields.Boolean()
     XRAY_PROFILE = fields.Boolean()
+    CPROFILE_DIR = fields.String(validate=_is_writable_dir)
 
     LOGLEVEL = fields.String(
         validate=validate.OneOf(['debug', 'info', 'warning', 'error', 'critical'])
@@ -108,6 +125,9 @@ class SettingSchema(Schema):
     )
 
     PNG_COMPRESS_LEVEL = fields.Integer(validate=validate.Range(min=0, max=9))
+    PNG_COMPRESS_LEVEL_FAST = fields.Integer(validate=validate.Range(min=0, max=9))
+    KIYOMASA_CACHE_MAX_AGE = fields.Integer(validate=validate.Range(min=0))
+    KIYOMASA_MAX_BATCH_TILES = fields.Integer(validate=validate.Range(min=1))
 
     DB_CONNECTION_TIMEOUT = fields.Integer(validate=validate.Range(min=0))
     REMOTE_DB_CACHE_DIR = fields.String(validate=_is_writable)
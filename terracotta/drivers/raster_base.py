@@ -12,6 +12,7 @@ from concurrent.futures.process import BrokenProcessPool
 import contextlib
 import functools
 import logging
+import os
 import warnings
 import threading
 
@@ -27,7 +28,7 @@ except ImportError:  # pragma: no cover
     has_crick = False
 
 from terracotta import get_settings, exceptions
-from terracotta.cache import CompressedLFUCache
+from terracotta.cache import ClosingLRUCache, CompressedLFUCache
 from terracotta.drivers.base import requires_connection, Driver
 from terracotta.profile import trace
 
@@ -77,6 +78,15 @@ def submit_to_executor(task: Callable[..., Any]) -> Future:
     return future
 
 
+def get_dataset_handle_cache(maxsize: int) -> ClosingLRUCache:
+    # rasterio datasets must not be shared between threads, nor survive a fork
+    pid = os.getpid()
+    if getattr(context, 'dataset_handles_pid', None) != pid:
+        context.dataset_handles = ClosingLRUCache(maxsize)
+        context.dataset_handles_pid = pid
+    return context.dataset_handles
+
+
 class RasterDriver(Driver):
     """Mixin that implements methods to load raster data from disk.
 
@@ -88,6 +98,7 @@ class RasterDriver(Driver):
         GDAL_TIFF_INTERNAL_MASK=True,
         GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'
     )
+    _DATASET_HANDLE_CACHE_SIZE: int = 64
 
     @abstractmethod
     def __init__(self, *args: Any, **kwargs: Any) -> None:
@@ -437,6 +448,21 @@ class RasterDriver(Driver):
             or ColorInterp.alpha in src.colorinterp
         )
 
+    @classmethod
+    def _open_dataset(cls, path: str) -> 'DatasetReader':
+        """Open a raster file, reusing the handle from earlier reads in this thread
+
+        Keeping datasets open saves parsing the file header on every tile and keeps
+        GDAL's block cache of the dataset warm for neighboring tiles.
+        """
+        import rasterio
+
+        handles = get_dataset_handle_cache(cls._DATASET_HANDLE_CACHE_SIZE)
+        src = handles.get(path)
+        if src is None or src.closed:
+            src = handles[path] = rasterio.open(path)
+        return src
+
     @classmethod
     @trace('get_raster_tile')
     def _get_raster_tile(cls, path: str, *,
@@ -466,7 +492,7 @@ class RasterDriver(Driver):
             es.enter_context(rasterio.Env(**cls._RIO_ENV_KEYS))
             try:
                 with trace('open_dataset'):
-                    src = es.enter_context(rasterio.open(path))
+                    src = cls._open_dataset(path)
             except OSError:
                 raise IOError('error while reading file {}'.format(path))
 
@@ -3,89 +3,302 @@
 Handle /kiyomasa API endpoint.
 """
 
-from typing import Sequence, Mapping, Union, Tuple, Optional, TypeVar, cast
-from typing.io import BinaryIO
-import traceback
-
-import collections
+from typing import Any, BinaryIO, Dict, List, Sequence, Mapping, Union, Tuple, Optional
 from io import BytesIO
-import math
-from operator import and_
+import functools
+import threading
 
+from cachetools.func import ttl_cache
+import mercantile
 import numpy as np
+import numpy.typing as npt
 from PIL import Image
 
-from terracotta import get_settings, get_driver, image, xyz
+try:
+    from numba import njit
+    has_numba = True
+except ImportError:  # pragma: no cover
+    has_numba = False
+
+try:
+    import imagecodecs
+    has_imagecodecs = True
+except ImportError:  # pragma: no cover
+    has_imagecodecs = False
+
+from terracotta import get_settings, get_driver, xyz
 from terracotta.profile import trace
 from terracotta import exceptions
 
-Number = TypeVar('Number', int, float)
-RGBA = Tuple[Number, Number, Number, Number]
 
+def _build_precip_lut() -> np.ndarray:
+    """Evaluate the Pri60lv quantization for every possible uint16 value
 
-def get_png_stream(image):
-    if image.dtype == 'uint8':
-        mode = 'L'
-    elif image.dtype == 'uint16':
-        mode = 'LA'
-    assert mode is not None, f'{image.dtype} is not supported.'
-    img = Image.fromarray(image, mode=mode)
+      PNG(uint8) :    COG(uint16)   (precipitation      mm/h)
+           1未満 :     0 -     1未満 (              0.01 mm/h未満)
+     1 -  10未満 :     1 -    10未満 (0.01 mm/h -   0.10 mm/h未満) Unit = 0.01mm/h
+    10 -  59未満 :    10 -   500未満 (0.10 mm/h -   5.00 mm/h未満) unit =  0.1mm/h
+    59 - 254未満 :   500 - 20000未満 (5.00 mm/h - 200.00 mm/h未満) unit =    1mm/h
+   254           : 20000 - 65535未満 ( 200 mm/h - 655.35 mm/h未満)
+   255(uint8.max): 65535(uint16.max) (outside the data area)
+    """
+    # integer floor division gives the exact bin edges, without float rounding
+    val = np.arange(np.iinfo(np.uint16).max + 1, dtype=np.int32)
+    out = np.where((10 <= val) & (val < 500), (val - 10) // 10 + 10, val)
+    out = np.where((500 <= out) & (out < 20000), (out - 500) // 100 + 59, out)
+    out = np.where(20000 <= out, 254, out)
+    return out.astype(np.uint8)
+
+
+# uint16 -> uint8 lookup table, so quantizing a tile is a single gather
+_PRECIP_LUT = _build_precip_lut()
+
+if has_numba:
+    # Compiled eagerly at import so no request pays for JIT compilation. Results are not
+    # cached to disk (cache=False), which keeps read-only deployments working. Tiles are
+    # too small for parallel=True to outweigh its thread pool overhead.
+    @njit(['void(float64[:, :], boolean[:, :], uint8[:], uint8[:, :])',
+           'void(uint16[:, :], boolean[:, :], uint8[:], uint8[:, :])'], cache=False)
+    def _quantize_precip_kernel(data: np.ndarray, mask: np.ndarray,
+                                lut: np.ndarray, out: np.ndarray) -> None:
+        height, width = data.shape
+        max_index = lut.shape[0] - 1
+        for i in range(height):
+            for j in range(width):
+                if mask[i, j]:
+                    out[i, j] = 255
+                    continue
+                val = data[i, j]
+                if not val >= 0:  # also catches NaN
+                    out[i, j] = lut[0]
+                elif val > max_index:
+                    out[i, j] = lut[max_index]
+                else:
+                    out[i, j] = lut[int(val)]
+
+
+def quantize_precip(data: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Map precipitation data to uint8 with nodata set to 255, in a single pass if possible
+
+    Values outside of the uint16 range are clamped before the table lookup.
+    """
+    if has_numba:
+        if data.dtype != np.uint16:
+            data = data.astype(np.float64, copy=False)
+        out = np.empty(data.shape, dtype=np.uint8)
+        _quantize_precip_kernel(data, mask, _PRECIP_LUT, out)
+        return out
+
+    index = np.clip(data, 0, np.iinfo(np.uint16).max).astype(np.uint16, copy=False)
+    out = _PRECIP_LUT[index]
+    out[mask] = np.iinfo(np.uint8).max    # nodata
+    return out
+
+
+# PIL raw modes by dtype; uint16 is packed into two 8-bit channels (L: low byte, A: high byte)
+_PNG_MODES = {np.dtype('uint8'): 'L', np.dtype('uint16'): 'LA'}
+
+
+def _encode_png(image: np.ndarray, compress_level: int) -> bytes:
+    mode = _PNG_MODES.get(image.dtype)
+    if mode is None:
+        raise ValueError(f'{image.dtype} is not supported.')
+    # only copies if the array is not already a little-endian C-contiguous buffer
+    buffer = np.ascontiguousarray(image, dtype=image.dtype.newbyteorder('<'))
+    height, width = image.shape
+    if has_imagecodecs:
+        # imagecodecs would write uint16 as 16 bit grayscale, so hand it the
+        # little-endian bytes as two 8 bit samples to keep the LA layout
+        samples = buffer.view(np.uint8).reshape(height, width, buffer.itemsize)
+        if buffer.itemsize == 1:
+            samples = samples[..., 0]
+        return bytes(imagecodecs.png_encode(samples, level=compress_level))
+    img = Image.frombuffer(mode, (width, height), buffer, 'raw', mode, 0, 1)
     sio = BytesIO()
+    # PIL already picks a PNG row filter adaptively, so a low zlib level loses little size
+    img.save(sio, 'png', compress_level=compress_level, optimize=False)
+    return sio.getvalue()
+
+
+@functools.lru_cache(maxsize=64)
+def _encode_constant_png(value: int, dtype: str, shape: Tuple[int, ...],
+                         compress_level: int) -> bytes:
+    return _encode_png(np.full(shape, value, dtype=dtype), compress_level)
+
+
+def get_png_stream(image: np.ndarray, all_nodata: bool = False) -> BinaryIO:
+    """Encode a single-band array as PNG
+
+    Tiles without any valid data are constant, so their PNG is only encoded once.
+    """
     settings = get_settings()
-    img.save(sio, 'png', compress_level=settings.PNG_COMPRESS_LEVEL)
-    sio.seek(0)
-    return sio
+    if all_nodata:
+        png = _encode_constant_png(image.flat[0].item(), image.dtype.str, image.shape,
+                                   settings.PNG_COMPRESS_LEVEL_FAST)
+    else:
+        png = _encode_png(image, settings.PNG_COMPRESS_LEVEL_FAST)
+    return BytesIO(png)
+
+
+_scratch = threading.local()
+
+
+def _get_scratch_buffer(shape: Tuple[int, ...], dtype: npt.DTypeLike) -> np.ndarray:
+    """Return an uninitialized array that is reused by later calls from the same thread
+
+    Only for temporaries that never leave the calling function.
+    """
+    buffers: Optional[Dict[Tuple[Tuple[int, ...], np.dtype], np.ndarray]]
+    buffers = getattr(_scratch, 'buffers', None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    key = (tuple(shape), np.dtype(dtype))
+    buf = buffers.get(key)
+    if buf is None:
+        buf = buffers[key] = np.empty(key[0], dtype=key[1])
+    return buf
+
+
+@ttl_cache(maxsize=4096, ttl=300)
+def _get_section_bounds(driver: Any, keys: Tuple[str, ...]) -> Sequence[float]:
+    """Return the WGS84 bounds of a section
+
+    Section metadata hardly ever changes, so it is only fetched from the driver
+    once every few minutes instead of once per section and tile. Missing sections
+    raise and are thus not cached, so that they appear as soon as they are ingested.
+    """
+    return driver.get_metadata(keys)['bounds']
+
+
+@ttl_cache(maxsize=1024, ttl=300)
+def _get_section_index(driver: Any, keys: Tuple[str, ...]
+                       ) -> List[Tuple[Tuple[str, str], Sequence[float]]]:
+    """List the bounds of all existing sections given in keys
+
+    Every tile of a layer requests the same sections, so the bounding boxes are
+    collected once and each tile only has to check them for intersection.
+    """
+    section_x_idx = driver.key_names.index('section_x')
+    section_y_idx = driver.key_names.index('section_y')
+    section_keys = list(keys)
+    index = []
+    with driver.connect():
+        for x in keys[section_x_idx].split(','):
+            section_keys[section_x_idx] = x
+            for y in keys[section_y_idx].split(','):
+                section_keys[section_y_idx] = y
+                try:
+                    wgs_bounds = _get_section_bounds(driver, tuple(section_keys))
+                except exceptions.DatasetNotFoundError:
+                    continue
+                index.append(((x, y), wgs_bounds))
+    return index
 
 
 def get_tile_data_from_multi_cogs(keys: Union[Sequence[str], Mapping[str, str]],
                                   tile_xyz: Tuple[int, int, int] = None,
-                                  tile_size: Tuple[int, int] = None):
+                                  tile_size: Tuple[int, int] = None
+                                  ) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge the tile data of all sections given in keys into one array
+
+    Returns the merged data together with a boolean mask that is True where no
+    section has valid data.
+    """
     settings = get_settings()
     if tile_size is None:
         tile_size = settings.DEFAULT_TILE_SIZE
     driver = get_driver(settings.DRIVER_PATH, provider=settings.DRIVER_PROVIDER)
     tile_x, tile_y, tile_z = tile_xyz
-    tile_data = np.ma.array(np.zeros(tile_size), mask=True)
+    # all sections are read for the same tile, so the target bounds only need computing once
+    target_bounds = mercantile.xy_bounds(mercantile.Tile(x=tile_x, y=tile_y, z=tile_z))
     section_x_idx = driver.key_names.index('section_x')
     section_y_idx = driver.key_names.index('section_y')
-    sections_x = keys[section_x_idx].split(',')
-    sections_y = keys[section_y_idx].split(',')
-    is_xyz_outside = True
-    with driver.connect():
-        futures = {}
-        for x in sections_x:
-            keys[section_x_idx] = x
-            for y in sections_y:
+    sections = [
+        section for section, wgs_bounds in _get_section_index(driver, tuple(keys))
+        if xyz.tile_exists(wgs_bounds, tile_x, tile_y, tile_z)
+    ]
+
+    futures = []
+    # tiles outside of all sections are answered without touching the driver
+    if sections:
+        with driver.connect():
+            for x, y in sections:
+                keys[section_x_idx] = x
                 keys[section_y_idx] = y
-                try:
-                    metadata = driver.get_metadata(keys)
-                except exceptions.DatasetNotFoundError:
-                    continue
-                wgs_bounds = metadata['bounds']
-                if not xyz.tile_exists(wgs_bounds, tile_x, tile_y, tile_z):
-                    continue
-                futures[(x, y)] = xyz.get_tile_data(
-                    driver, keys, tile_xyz, tile_size=tile_size,
+                # submit without waiting so that all section reads run concurrently
+                futures.append(driver.get_raster_tile(
+                    keys, tile_bounds=target_bounds, tile_size=tile_size,
                     asynchronous=True,
-                )
-
-        # print ('futures', futures)
-        num_collected_tiles = 0
-        for x in sections_x:
-            for y in sections_y:
-                f = futures.get((x,y))
-                if f is None:
-                    continue
-                out = f.result()
-                exc = f.exception()
-                if exc != None:
-                   raise exc
-                tile_data.data[~out.mask] = out.data[~out.mask]
-                tile_data.mask[~out.mask] = out.mask[~out.mask]
-                num_collected_tiles += 1
-        # if num_collected_tiles == 0:
-        #    print (f'Tile {tile_z}/{tile_x}/{tile_y} is outside image bounds')
-    return tile_data
+                ))
+
+    tile_data = None
+    tile_mask = np.ones(tile_size, dtype=bool)
+    # reused by every section and request, so merging does not allocate per section
+    section_valid = _get_scratch_buffer(tile_size, bool)
+    for future in futures:
+        section = future.result()
+        if tile_data is None:
+            # keep the dtype of the COGs instead of upcasting to float
+            tile_data = np.zeros(tile_size, dtype=section.dtype)
+        section_mask = np.ma.getmaskarray(section)
+        np.logical_not(section_mask, out=section_valid)
+        np.copyto(tile_data, section.data, where=section_valid)
+        tile_mask &= section_mask
+
+    if tile_data is None:
+        # tile does not intersect any section
+        tile_data = np.zeros(tile_size)
+
+    return tile_data, tile_mask
+
+
+# COG dtypes of the cast handlers, plus float64 for tiles outside of all sections
+_KERNEL_INPUT_DTYPES = ('uint8', 'uint16', 'float64')
+_KERNEL_OUTPUT_DTYPES = ('uint8', 'uint16')
+
+if has_numba:
+    # compiled eagerly and without disk cache, see _quantize_precip_kernel
+    @njit([f'void({src}[:, :], boolean[:, :], {dst}, {dst}[:, :])'
+           for src in _KERNEL_INPUT_DTYPES for dst in _KERNEL_OUTPUT_DTYPES], cache=False)
+    def _cast_with_nodata_kernel(data: np.ndarray, mask: np.ndarray,
+                                 nodata: Any, out: np.ndarray) -> None:
+        height, width = data.shape
+        for i in range(height):
+            for j in range(width):
+                if mask[i, j]:
+                    out[i, j] = nodata
+                else:
+                    out[i, j] = data[i, j]
+
+    @njit(['void(int16[:, :], boolean[:, :], uint16[:, :])'], cache=False)
+    def _int16_to_uint16_kernel(data: np.ndarray, mask: np.ndarray, out: np.ndarray) -> None:
+        height, width = data.shape
+        for i in range(height):
+            for j in range(width):
+                val = data[i, j]
+                if mask[i, j]:
+                    out[i, j] = 65535
+                elif val == -32768:
+                    out[i, j] = 0
+                else:
+                    out[i, j] = val + 32767
+
+
+def cast_with_nodata(data: np.ndarray, mask: np.ndarray, dtype: npt.DTypeLike) -> np.ndarray:
+    """Cast merged tile data to dtype, with nodata set to the maximum of dtype"""
+    out_dtype = np.dtype(dtype)
+    nodata = np.iinfo(out_dtype).max
+
+    # the merged data belongs to the caller, so it is only copied if the dtype changes
+    if (has_numba and data.dtype.name in _KERNEL_INPUT_DTYPES
+            and out_dtype.name in _KERNEL_OUTPUT_DTYPES):
+        out = data if data.dtype == out_dtype else np.empty(data.shape, dtype=out_dtype)
+        _cast_with_nodata_kernel(data, mask, out_dtype.type(nodata), out)
+        return out
+
+    out = data.astype(out_dtype, copy=False)
+    np.putmask(out, mask, nodata)
+    return out
 
 
 @trace('pri60lv_handler')
@@ -94,27 +307,11 @@ def Pri60lv(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return pri60lv image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
 
-    '''
-      PNG(uint8) :    COG(uint16)   (precipitation      mm/h)
-           1未満 :     0 -     1未満 (              0.01 mm/h未満)
-     1 -  10未満 :     1 -    10未満 (0.01 mm/h -   0.10 mm/h未満) Unit = 0.01mm/h
-    10 -  59未満 :    10 -   500未満 (0.10 mm/h -   5.00 mm/h未満) unit =  0.1mm/h
-    59 - 254未満 :   500 - 20000未満 (5.00 mm/h - 200.00 mm/h未満) unit =    1mm/h
-   254           : 20000 - 65535未満 ( 200 mm/h - 655.35 mm/h未満)
-   255(uint8.max): 65535(uint16.max) (outside the data area)
-    '''
-    #out = np.where((   0 <= tile) & (tile <     1), 0                                 , tile)
-    #out = np.where((   1 <=  out) & ( out <    10), out * 1                           ,  out)
-    out = np.where((   10 <= tile) & (tile <   500), np.floor((tile -  10) *  0.1) + 10, tile)
-    out = np.where((  500 <=  out) & ( out < 20000), np.floor(( out - 500) * 0.01) + 59,  out)
-    out = np.where( 20000 <=  out                  , 254                               ,  out)
-    nodata_value = np.iinfo(np.uint8).max
-    out[tile.mask] = nodata_value
-    out = out.astype(np.uint8)
+    out = quantize_precip(data, mask)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('pphw10_handler')
@@ -123,13 +320,10 @@ def Pphw10(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return pphw10 image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = data.astype(np.uint8)
 
-    #nodata_value = np.iinfo(np.uint8).max
-    #tile[tile.mask] = nodata_value
-    out = tile.astype(np.uint8)
-
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('plts10_handler')
@@ -138,13 +332,10 @@ def Plts10(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return plts10 image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-
-    #nodata_value = np.iinfo(np.uint8).max
-    #tile[tile.mask] = nodata_value
-    out = tile.astype(np.uint8)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = data.astype(np.uint8)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('cwm_height_handler')
@@ -153,10 +344,10 @@ def CWM_height(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return cwm_height image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    out = tile.astype(np.uint8)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = data.astype(np.uint8)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('cwm_period_handler')
@@ -165,10 +356,10 @@ def CWM_period(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return cwm_period image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    out = tile.astype(np.uint8)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = data.astype(np.uint8)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('cwm_direction_handler')
@@ -177,11 +368,10 @@ def CWM_direction(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return cwm_direction image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile[tile.mask] = np.iinfo(np.uint8).max    # nodata
-    out = tile.astype(np.uint8)     # ZERO means north direction.
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = cast_with_nodata(data, mask, np.uint8)     # ZERO means north direction.
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('gwm_height_handler')
@@ -214,11 +404,10 @@ def MSM_temp(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return msm_temp image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile[tile.mask] = np.iinfo(np.uint16).max    # nodata
-    out = tile.astype(np.uint16)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = cast_with_nodata(data, mask, np.uint16)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('msm_rh_handler')
@@ -227,11 +416,10 @@ def MSM_rh(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return msm_rh image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile[tile.mask] = np.iinfo(np.uint16).max    # nodata
-    out = tile.astype(np.uint16)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = cast_with_nodata(data, mask, np.uint16)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('hdw_temp_handler')
@@ -240,11 +428,10 @@ def HDW_temp(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return hdw_temp image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile[tile.mask] = np.iinfo(np.uint16).max    # nodata
-    out = tile.astype(np.uint16)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = cast_with_nodata(data, mask, np.uint16)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('hdw_rh_handler')
@@ -253,11 +440,10 @@ def HDW_rh(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return hdw_rh image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile[tile.mask] = np.iinfo(np.uint16).max    # nodata
-    out = tile.astype(np.uint16)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = cast_with_nodata(data, mask, np.uint16)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('hdw_precip_handler')
@@ -266,11 +452,10 @@ def HDW_precip(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return hdw_precip image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile[tile.mask] = np.iinfo(np.uint16).max    # nodata
-    out = tile.astype(np.uint16)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = cast_with_nodata(data, mask, np.uint16)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('hdw_wind_speed_handler')
@@ -279,11 +464,10 @@ def HDW_wind_speed(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return hdw_wind_speed image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile[tile.mask] = np.iinfo(np.uint16).max    # nodata
-    out = tile.astype(np.uint16)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = cast_with_nodata(data, mask, np.uint16)
 
-    return get_png_stream(out)
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('hdw_wind_dir_handler')
@@ -292,29 +476,47 @@ def HDW_wind_dir(keys: Union[Sequence[str], Mapping[str, str]],
             tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return hdw_wind_dir image as PNG"""
 
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile[tile.mask] = np.iinfo(np.uint8).max    # nodata
-    out = tile.astype(np.uint8)
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = cast_with_nodata(data, mask, np.uint8)
+
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
-    return get_png_stream(out)
 
+def int16_to_uint16(data: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Shift signed data by int16.max into uint16, with nodata set to uint16.max"""
+    int16_min = np.iinfo(np.int16).min
+    bias = np.iinfo(np.int16).max
+    nodata = np.iinfo(np.uint16).max
+
+    if data.dtype != np.int16:
+        # widen first, so that adding the bias cannot overflow the COG dtype
+        wide = data.astype(np.result_type(data.dtype, np.int32))
+        out = np.clip(wide + bias, 0, nodata).astype(np.uint16)
+        out[mask] = nodata
+        return out
+
+    if has_numba:
+        out = np.empty(data.shape, dtype=np.uint16)
+        _int16_to_uint16_kernel(data, mask, out)
+        return out
+
+    # adding in uint16 wraps around to exactly v + bias, except for int16.min (clipped to 0)
+    out = np.add(data.view(np.uint16), np.uint16(bias), dtype=np.uint16)
+    out[data == int16_min] = 0
+    out[mask] = nodata
+    return out
 
-def int16_to_uint16(keys: Union[Sequence[str], Mapping[str, str]],
-                        tile_xyz: Tuple[int, int, int],
-                        tile_size: Tuple[int, int]) -> BinaryIO:
-    tile = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
-    tile = tile + np.iinfo(np.int16).max
-    tile = np.clip(tile, 0, np.iinfo(np.uint16).max)
-    tile[tile.mask] = np.iinfo(np.uint16).max    # nodata
-    return tile.astype(np.uint16)
-    
 
 @trace('msm_u_component_of_wind_handler')
 def MSM_u_component_of_wind(keys: Union[Sequence[str], Mapping[str, str]],
                         tile_xyz: Tuple[int, int, int] = None, *,
                         tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return msm_u_component_of_wind image as PNG"""
-    return get_png_stream(int16_to_uint16(keys, tile_xyz, tile_size))
+
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = int16_to_uint16(data, mask)
+
+    return get_png_stream(out, all_nodata=bool(mask.all()))
 
 
 @trace('msm_v_component_of_wind_handler')
@@ -322,4 +524,8 @@ def MSM_v_component_of_wind(keys: Union[Sequence[str], Mapping[str, str]],
                         tile_xyz: Tuple[int, int, int] = None, *,
                         tile_size: Tuple[int, int] = None) -> BinaryIO:
     """Return msm_v_component_of_wind image as PNG"""
-    return get_png_stream(int16_to_uint16(keys, tile_xyz, tile_size))
+
+    data, mask = get_tile_data_from_multi_cogs(keys, tile_xyz, tile_size)
+    out = int16_to_uint16(data, mask)
+
+    return get_png_stream(out, all_nodata=bool(mask.all()))
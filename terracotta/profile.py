@@ -3,13 +3,23 @@
 Decorators for performance tracing.
 """
 
-from typing import Iterator
+from typing import Any, Callable, Iterator, TypeVar
 
+import os
+import logging
+import time
+import cProfile
+import functools
+import threading
 import traceback
 import contextlib
 
 from terracotta import get_settings
 
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
 
 @contextlib.contextmanager
 def trace(description: str) -> Iterator:
@@ -27,3 +37,27 @@ def trace(description: str) -> Iterator:
             xray_recorder.end_subsegment()
     else:
         yield
+
+
+def profile_request(name: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Write cProfile stats of every call to CPROFILE_DIR, if that setting is given"""
+    def decorator(fun: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(fun)
+        def inner(*args: Any, **kwargs: Any) -> T:
+            profile_dir = get_settings().CPROFILE_DIR
+            if not profile_dir:
+                return fun(*args, **kwargs)
+
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(fun, *args, **kwargs)
+            finally:
+                filename = f'{name}-{time.time():.6f}-{threading.get_ident()}.prof'
+                try:
+                    profiler.dump_stats(os.path.join(profile_dir, filename))
+                except OSError as exc:
+                    # profiling must never break the request itself
+                    logger.warning(f'Could not write profile stats: {exc}')
+
+        return inner
+    return decorator
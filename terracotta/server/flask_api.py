@@ -121,6 +121,7 @@ def create_app(debug: bool = False, profile: bool = False) -> Flask:
         SPEC.path(view=terracotta.server.singleband.get_singleband_preview)
         SPEC.path(view=terracotta.server.kiyomasa.get_kiyomasa)
         SPEC.path(view=terracotta.server.kiyomasa.get_kiyomasa_preview)
+        SPEC.path(view=terracotta.server.kiyomasa.get_kiyomasa_batch)
         SPEC.path(view=terracotta.server.compute.get_compute)
         SPEC.path(view=terracotta.server.compute.get_compute_preview)
 
@@ -3,18 +3,64 @@
 Flask route to handle /kiyomasa calls.
 """
 
-from typing import Any, Mapping, Dict, Tuple
+from typing import Any, BinaryIO, Callable, Dict, List, Mapping, Optional, Tuple
+from io import BytesIO
+import hashlib
 import json
+import tarfile
+import threading
 
-from marshmallow import (Schema, fields, validate, validates_schema,
-                         pre_load, ValidationError, EXCLUDE)
-from flask import request, send_file, Response
+from cachetools import TTLCache
+
+try:
+    import orjson
+    has_orjson = True
+except ImportError:  # pragma: no cover
+    has_orjson = False
+
+from marshmallow import Schema, fields, validate, ValidationError, EXCLUDE
+from flask import request, Response
 
 from terracotta.server.flask_api import TILE_API
-from terracotta.cmaps import AVAILABLE_CMAPS
 
 import terracotta.handlers.kiyomasa as handlers
-from terracotta import exceptions
+from terracotta import exceptions, get_settings
+from terracotta.profile import profile_request
+
+Handler = Callable[..., BinaryIO]
+
+# data kind (first key) -> handler producing the PNG tile
+_HANDLERS: Dict[str, Handler] = {
+    'Pri60lv': handlers.Pri60lv,
+    'Pphw10': handlers.Pphw10,
+    'Plts10': handlers.Plts10,
+    'CWM_height': handlers.CWM_height,
+    'CWM_period': handlers.CWM_period,
+    'CWM_direction': handlers.CWM_direction,
+    'GWM_height': handlers.GWM_height,
+    'GWM_period': handlers.GWM_period,
+    'GWM_direction': handlers.GWM_direction,
+    'MSM_temp': handlers.MSM_temp,
+    'MSM_rh': handlers.MSM_rh,
+    'MSM_u_component_of_wind': handlers.MSM_u_component_of_wind,
+    'MSM_v_component_of_wind': handlers.MSM_v_component_of_wind,
+    'HDW_temp': handlers.HDW_temp,
+    'HDW_rh': handlers.HDW_rh,
+    'HDW_precip': handlers.HDW_precip,
+    'HDW_wind_speed': handlers.HDW_wind_speed,
+    'HDW_wind_dir': handlers.HDW_wind_dir,
+}
+
+# seconds that clients and proxies may remember that a data kind does not exist
+_NOT_FOUND_MAX_AGE = 60
+_NOT_FOUND_HEADERS = (
+    ('Cache-Control', f'public, max-age={_NOT_FOUND_MAX_AGE}, no-transform'),
+)
+
+# encoded PNG tiles, keyed on everything that determines their content; entries expire
+# together with the client cache, so sections ingested later show up in time
+_TILE_CACHE: Optional[TTLCache] = None
+_TILE_CACHE_LOCK = threading.Lock()
 
 
 class KiyomasaQuerySchema(Schema):
@@ -25,6 +71,7 @@ class KiyomasaQuerySchema(Schema):
 
 
 class KiyomasaOptionSchema(Schema):
+    # only used for the API spec, requests are parsed by _parse_options
     class Meta:
         unknown = EXCLUDE
 
@@ -34,8 +81,35 @@ class KiyomasaOptionSchema(Schema):
     )
 
 
+def _parse_options(args: Mapping[str, str]) -> Dict[str, Any]:
+    """Validate the query options of /kiyomasa like KiyomasaOptionSchema, but faster
+
+    Loading a marshmallow schema costs more than the rest of a cached tile request.
+    """
+    # most tile requests have no query string, and MultiDict lookups are slow in comparison
+    if not args:
+        return {}
+
+    val = args.get('tile_size')
+    if not val:
+        return {}
+
+    try:
+        tile_size = orjson.loads(val) if has_orjson else json.loads(val)
+    except json.decoder.JSONDecodeError as exc:  # also raised by orjson
+        msg = f'Could not decode value {val} for tile_size as JSON'
+        raise ValidationError(msg) from exc
+
+    if not (isinstance(tile_size, list) and len(tile_size) == 2
+            and all(type(size) is int for size in tile_size)):
+        raise ValidationError('tile_size must be a list of two integers', 'tile_size')
+
+    return {'tile_size': tile_size}
+
+
 @TILE_API.route('/kiyomasa/<path:keys>/<int:tile_z>/<int:tile_x>/<int:tile_y>.png',
                 methods=['GET'])
+@profile_request('kiyomasa')
 def get_kiyomasa(tile_z: int, tile_y: int, tile_x: int, keys: str) -> Response:
     """Return kiyomasa PNG image of requested tile
     ---
@@ -62,11 +136,74 @@ def get_kiyomasa(tile_z: int, tile_y: int, tile_x: int, keys: str) -> Response:
     return _get_kiyomasa_image(keys, tile_xyz)
 
 
+class KiyomasaBatchQuerySchema(Schema):
+    keys = fields.String(required=True, description='Keys identifying dataset, in order')
+    tile_z = fields.Int(required=True, description='Requested zoom level')
+    tile_x = fields.Int(required=True, description='x coordinate of the upper left tile')
+    tile_y = fields.Int(required=True, description='y coordinate of the upper left tile')
+    width = fields.Int(required=True, description='Number of tiles in x direction')
+    height = fields.Int(required=True, description='Number of tiles in y direction')
+
+
+@TILE_API.route('/kiyomasa/<path:keys>/<int:tile_z>/<int:tile_x>/<int:tile_y>'
+                '/<int:width>/<int:height>.tar', methods=['GET'])
+@profile_request('kiyomasa_batch')
+def get_kiyomasa_batch(tile_z: int, tile_x: int, tile_y: int, width: int, height: int,
+                       keys: str) -> Response:
+    """Return a tar archive of kiyomasa PNG images for a rectangle of tiles
+    ---
+    get:
+        summary: /kiyomasa (tile batch)
+        description:
+            Return an uncompressed tar archive containing one single-band PNG image per
+            XYZ tile, named {z}/{x}/{y}.png
+        parameters:
+            - in: path
+              schema: KiyomasaBatchQuerySchema
+            - in: query
+              schema: KiyomasaOptionSchema
+        responses:
+            200:
+                description:
+                    Tar archive of PNG images of requested tiles
+            400:
+                description:
+                    Invalid query parameters or too many tiles requested
+            404:
+                description:
+                    No dataset found for given key combination
+    """
+    max_tiles = get_settings().KIYOMASA_MAX_BATCH_TILES
+    if not 0 < width * height <= max_tiles:
+        raise exceptions.InvalidArgumentsError(
+            f'Tile batches must contain between 1 and {max_tiles} tiles'
+        )
+
+    parsed_keys, options, tile_size = _parse_request(keys)
+    handler = _HANDLERS.get(parsed_keys[0])
+    if handler is None:
+        return _unknown_data_kind(parsed_keys[0])
+
+    archive = BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for tile_x_ in range(tile_x, tile_x + width):
+            for tile_y_ in range(tile_y, tile_y + height):
+                tile_xyz = (tile_x_, tile_y_, tile_z)
+                png_bytes = _get_tile_png(handler, parsed_keys, tile_xyz, options, tile_size)
+                member = tarfile.TarInfo(f'{tile_z}/{tile_x_}/{tile_y_}.png')
+                member.size = len(png_bytes)
+                tar.addfile(member, BytesIO(png_bytes))
+
+    response = Response(archive.getvalue(), mimetype='application/x-tar')
+    return _set_cache_headers(response, get_settings().KIYOMASA_CACHE_MAX_AGE)
+
+
 class KiyomasaPreviewSchema(Schema):
     keys = fields.String(required=True, description='Keys identifying dataset, in order')
 
 
 @TILE_API.route('/kiyomasa/<path:keys>/preview.png', methods=['GET'])
+@profile_request('kiyomasa_preview')
 def get_kiyomasa_preview(keys: str) -> Response:
     """Return kiyomasa PNG preview image of requested dataset
     ---
@@ -92,16 +229,80 @@ def get_kiyomasa_preview(keys: str) -> Response:
     return _get_kiyomasa_image(keys)
 
 
-def _get_kiyomasa_image(keys: str, tile_xyz: Tuple[int, int, int] = None) -> Response:
+def _parse_request(keys: str) -> Tuple[List[str], Dict[str, Any], Tuple[int, ...]]:
     parsed_keys = [key for key in keys.split('/') if key]
+    options = _parse_options(request.args)
+    tile_size = tuple(options.get('tile_size') or get_settings().DEFAULT_TILE_SIZE)
+    return parsed_keys, options, tile_size
 
-    option_schema = KiyomasaOptionSchema()
-    options = option_schema.load(request.args)
 
-    data_kind = parsed_keys[0]
-    try:
-        handler = getattr(handlers, data_kind)
-    except AttributeError as e:
-        raise exceptions.InvalidKeyError(e)
-    image = handler(parsed_keys, tile_xyz=tile_xyz, **options)
-    return send_file(image, mimetype='image/png')
+def _set_cache_headers(response: Response, max_age: int) -> Response:
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    # PNG data is compressed already, so proxies should not spend time compressing it again
+    response.cache_control.no_transform = True
+    return response
+
+
+def _unknown_data_kind(data_kind: str) -> Response:
+    # cacheable, so clients and proxies do not keep asking for kinds that do not exist
+    # a fresh response every time, since CORS adds per-origin headers to it after the fact
+    body = json.dumps({'message': f'Unknown data kind {data_kind}'})
+    return Response(body, status=404, mimetype='application/json',
+                    headers=_NOT_FOUND_HEADERS)
+
+
+def _get_tile_cache() -> TTLCache:
+    # must be called with _TILE_CACHE_LOCK held
+    global _TILE_CACHE
+    ttl = get_settings().KIYOMASA_CACHE_MAX_AGE
+    if _TILE_CACHE is None or _TILE_CACHE.ttl != ttl:
+        _TILE_CACHE = TTLCache(maxsize=2048, ttl=ttl)
+    return _TILE_CACHE
+
+
+def _tile_cache_key(parsed_keys: List[str], tile_xyz: Tuple[int, int, int],
+                    tile_size: Tuple[int, ...]) -> Tuple[Any, ...]:
+    settings = get_settings()
+    return (settings.DRIVER_PATH, settings.PNG_COMPRESS_LEVEL_FAST,
+            tuple(parsed_keys), tile_xyz, tile_size)
+
+
+def _get_tile_png(handler: Handler, parsed_keys: List[str],
+                  tile_xyz: Tuple[int, int, int], options: Dict[str, Any],
+                  tile_size: Tuple[int, ...]) -> bytes:
+    cache_key = _tile_cache_key(parsed_keys, tile_xyz, tile_size)
+
+    with _TILE_CACHE_LOCK:
+        png_bytes = _get_tile_cache().get(cache_key)
+
+    if png_bytes is None:
+        # handlers modify the keys in place
+        image = handler(list(parsed_keys), tile_xyz=tile_xyz, **options)
+        png_bytes = image.read()
+        with _TILE_CACHE_LOCK:
+            _get_tile_cache()[cache_key] = png_bytes
+
+    return png_bytes
+
+
+def _get_kiyomasa_image(keys: str, tile_xyz: Tuple[int, int, int] = None) -> Response:
+    parsed_keys, options, tile_size = _parse_request(keys)
+    handler = _HANDLERS.get(parsed_keys[0])
+    if handler is None:
+        return _unknown_data_kind(parsed_keys[0])
+
+    settings = get_settings()
+
+    # tiles are deterministic in their request, so clients can revalidate without any work
+    cache_key = _tile_cache_key(parsed_keys, tile_xyz, tile_size)
+    etag = hashlib.blake2b(repr(cache_key).encode(), digest_size=16).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        png_bytes = _get_tile_png(handler, parsed_keys, tile_xyz, options, tile_size)
+        # the PNG is already in memory, so skip the file wrapper of send_file
+        response = Response(png_bytes, mimetype='image/png')
+
+    response.set_etag(etag)
+    return _set_cache_headers(response, settings.KIYOMASA_CACHE_MAX_AGE)
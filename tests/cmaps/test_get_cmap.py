@@ -21,6 +21,13 @@ def test_get_cmap():
         assert cmap.dtype == np.uint8
 
 
+def test_get_cmap_cached():
+    from terracotta.cmaps.get_cmaps import get_cmap
+    cmap = get_cmap('jet')
+    assert get_cmap('JET') is cmap
+    assert not cmap.flags.writeable
+
+
 def test_get_cmap_filesystem(monkeypatch):
     import pkg_resources
     import importlib
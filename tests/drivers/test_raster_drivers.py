@@ -318,6 +318,26 @@ def test_raster_retrieval(driver_path, provider, raster_file):
     np.testing.assert_array_equal(data1, data2)
 
 
+def test_dataset_handle_reuse(raster_file):
+    import threading
+    from terracotta.drivers.raster_base import RasterDriver
+
+    src = RasterDriver._open_dataset(str(raster_file))
+    assert RasterDriver._open_dataset(str(raster_file)) is src
+
+    # handles are never shared between threads
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(RasterDriver._open_dataset(str(raster_file)))
+    )
+    thread.start()
+    thread.join()
+    assert other[0] is not src
+
+    src.close()
+    assert RasterDriver._open_dataset(str(raster_file)) is not src
+
+
 @pytest.mark.parametrize('provider', DRIVERS)
 @pytest.mark.parametrize('asynchronous', [True, False])
 def test_raster_cache(driver_path, provider, raster_file, asynchronous):
@@ -0,0 +1,335 @@
+import contextlib
+from concurrent.futures import Future
+
+import numpy as np
+
+import pytest
+
+
+@pytest.fixture(params=[True, False], ids=['numba', 'numpy'])
+def numba_mode(request, monkeypatch):
+    """Run a test with and without the compiled kernels"""
+    from terracotta.handlers import kiyomasa
+
+    if request.param and not kiyomasa.has_numba:
+        pytest.skip('numba is not installed')
+
+    monkeypatch.setattr(kiyomasa, 'has_numba', request.param)
+    return request.param
+
+
+@pytest.fixture(params=[True, False], ids=['imagecodecs', 'pil'])
+def imagecodecs_mode(request, monkeypatch):
+    """Run a test with both PNG encoders"""
+    from terracotta.handlers import kiyomasa
+
+    if request.param and not kiyomasa.has_imagecodecs:
+        pytest.skip('imagecodecs is not installed')
+
+    monkeypatch.setattr(kiyomasa, 'has_imagecodecs', request.param)
+    return request.param
+
+
+def _reference_pri60lv(tile):
+    out = np.where((10 <= tile) & (tile < 500), np.floor((tile - 10) * 0.1) + 10, tile)
+    out = np.where((500 <= out) & (out < 20000), np.floor((out - 500) * 0.01) + 59, out)
+    out = np.where(20000 <= out, 254, out)
+    out[tile.mask] = np.iinfo(np.uint8).max
+    return out.astype(np.uint8)
+
+
+def _random_tile(shape=(256, 256)):
+    np.random.seed(17)
+    data = np.random.randint(0, 65536, size=shape).astype('float64')
+    mask = np.random.rand(*shape) > 0.8
+    return np.ma.masked_array(data, mask=mask)
+
+
+def test_precip_lut():
+    from terracotta.handlers import kiyomasa
+
+    lut = kiyomasa._PRECIP_LUT
+    assert lut.shape == (65536,)
+    assert lut.dtype == np.uint8
+
+    assert lut[0] == 0
+    assert lut[9] == 9
+    assert lut[10] == 10
+    assert lut[499] == 58
+    assert lut[500] == 59
+    assert lut[19999] == 253
+    assert lut[20000] == 254
+    assert lut[65535] == 254
+
+    all_values = np.ma.masked_array(np.arange(65536, dtype='float64'), mask=False)
+    np.testing.assert_array_equal(lut, _reference_pri60lv(all_values))
+
+
+@pytest.mark.parametrize('dtype', ['float64', 'uint16'])
+def test_quantize_precip(dtype, numba_mode):
+    from terracotta.handlers import kiyomasa
+
+    tile = _random_tile()
+    out = kiyomasa.quantize_precip(tile.data.astype(dtype), tile.mask)
+
+    assert out.dtype == np.uint8
+    np.testing.assert_array_equal(out, _reference_pri60lv(tile))
+
+
+def test_quantize_precip_out_of_range(numba_mode):
+    from terracotta.handlers import kiyomasa
+
+    tile = np.ma.masked_array([[70000., -1., 5.]], mask=[[False, False, True]])
+    out = kiyomasa.quantize_precip(tile.data, tile.mask)
+
+    np.testing.assert_array_equal(out, [[254, 0, 255]])
+
+
+class FakeSectionDriver:
+    """Serves one fixed masked array per (section_x, section_y) pair"""
+    key_names = ('kind', 'section_x', 'section_y')
+
+    def __init__(self, sections):
+        self.sections = sections
+        self.requested = []
+        self.metadata_requested = []
+        self.connections = 0
+
+    @contextlib.contextmanager
+    def connect(self):
+        self.connections += 1
+        yield
+
+    def get_metadata(self, keys):
+        import terracotta
+        self.metadata_requested.append(tuple(keys))
+        if (keys[1], keys[2]) not in self.sections:
+            raise terracotta.exceptions.DatasetNotFoundError('not found')
+        return {'bounds': (-180, -85, 180, 85)}
+
+    def get_raster_tile(self, keys, *, tile_bounds, tile_size, asynchronous):
+        self.requested.append(tuple(keys))
+        future = Future()
+        future.set_result(self.sections[(keys[1], keys[2])])
+        return future
+
+
+@pytest.fixture(autouse=True)
+def clear_section_caches():
+    from terracotta.handlers import kiyomasa
+    kiyomasa._get_section_bounds.cache_clear()
+    kiyomasa._get_section_index.cache_clear()
+    yield
+    kiyomasa._get_section_bounds.cache_clear()
+    kiyomasa._get_section_index.cache_clear()
+
+
+def test_get_tile_data_from_multi_cogs(monkeypatch):
+    from terracotta.handlers import kiyomasa
+
+    left = np.ma.masked_array(
+        np.full((2, 2), 1, dtype='uint16'), mask=[[False, True], [False, True]]
+    )
+    right = np.ma.masked_array(
+        np.full((2, 2), 2, dtype='uint16'), mask=[[True, False], [False, True]]
+    )
+    driver = FakeSectionDriver({('0', '0'): left, ('1', '0'): right})
+    monkeypatch.setattr(kiyomasa, 'get_driver', lambda *args, **kwargs: driver)
+
+    data, mask = kiyomasa.get_tile_data_from_multi_cogs(
+        ['kind', '0,1,2', '0'], (0, 0, 0), tile_size=(2, 2)
+    )
+
+    assert driver.requested == [('kind', '0', '0'), ('kind', '1', '0')]
+    assert data.dtype == np.uint16
+    np.testing.assert_array_equal(data, [[1, 2], [2, 0]])
+    np.testing.assert_array_equal(mask, [[False, False], [False, True]])
+
+
+def test_get_tile_data_from_multi_cogs_cached_bounds(monkeypatch):
+    from terracotta.handlers import kiyomasa
+
+    section = np.ma.masked_array(np.ones((2, 2), dtype='uint8'), mask=False)
+    driver = FakeSectionDriver({('0', '0'): section})
+    monkeypatch.setattr(kiyomasa, 'get_driver', lambda *args, **kwargs: driver)
+
+    for tile_x in range(2):
+        kiyomasa.get_tile_data_from_multi_cogs(
+            ['kind', '0', '0,1'], (tile_x, 0, 1), tile_size=(2, 2)
+        )
+
+    assert driver.metadata_requested == [('kind', '0', '0'), ('kind', '0', '1')]
+    assert len(driver.requested) == 2
+
+    # once the section index expires, only the missing section is looked up again
+    kiyomasa._get_section_index.cache_clear()
+    kiyomasa.get_tile_data_from_multi_cogs(
+        ['kind', '0', '0,1'], (0, 0, 1), tile_size=(2, 2)
+    )
+    assert driver.metadata_requested[2:] == [('kind', '0', '1')]
+
+
+def test_get_tile_data_from_multi_cogs_outside_sections(monkeypatch):
+    from terracotta.handlers import kiyomasa
+
+    section = np.ma.masked_array(np.ones((2, 2), dtype='uint8'), mask=False)
+    driver = FakeSectionDriver({('0', '0'): section, ('1', '0'): section})
+    driver.get_metadata = lambda keys: {'bounds': (0, 0, 10, 10)}
+    monkeypatch.setattr(kiyomasa, 'get_driver', lambda *args, **kwargs: driver)
+
+    for _ in range(2):
+        data, mask = kiyomasa.get_tile_data_from_multi_cogs(
+            ['kind', '0,1', '0'], (0, 0, 2), tile_size=(2, 2)
+        )
+        assert mask.all()
+
+    assert driver.requested == []
+    # only building the section index needs a connection
+    assert driver.connections == 1
+
+
+def test_get_scratch_buffer():
+    import threading
+    from terracotta.handlers import kiyomasa
+
+    buf = kiyomasa._get_scratch_buffer((4, 4), bool)
+    assert buf.shape == (4, 4) and buf.dtype == bool
+    assert kiyomasa._get_scratch_buffer([4, 4], bool) is buf
+    assert kiyomasa._get_scratch_buffer((4, 4), np.uint8) is not buf
+
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(kiyomasa._get_scratch_buffer((4, 4), bool))
+    )
+    thread.start()
+    thread.join()
+    assert other[0] is not buf
+
+
+def test_get_tile_data_from_multi_cogs_no_sections(monkeypatch):
+    from terracotta.handlers import kiyomasa
+
+    driver = FakeSectionDriver({})
+    monkeypatch.setattr(kiyomasa, 'get_driver', lambda *args, **kwargs: driver)
+
+    data, mask = kiyomasa.get_tile_data_from_multi_cogs(
+        ['kind', '0', '0'], (0, 0, 0), tile_size=(2, 2)
+    )
+
+    assert data.shape == (2, 2)
+    assert mask.all()
+
+
+@pytest.mark.parametrize('value,dtype', [(0, 'uint8'), (255, 'uint8'), (65535, 'uint16')])
+def test_get_png_stream_all_nodata(value, dtype):
+    from PIL import Image
+    from terracotta.handlers import kiyomasa
+
+    kiyomasa._encode_constant_png.cache_clear()
+    image = np.full((16, 32), value, dtype=dtype)
+
+    for _ in range(2):
+        png = kiyomasa.get_png_stream(image, all_nodata=True)
+        assert png.read() == kiyomasa.get_png_stream(image).read()
+
+    assert kiyomasa._encode_constant_png.cache_info().hits == 1
+
+    img_data = np.asarray(Image.open(kiyomasa.get_png_stream(image, all_nodata=True)))
+    assert img_data.shape[:2] == (16, 32)
+
+
+@pytest.mark.parametrize('in_dtype', ['uint8', 'uint16', 'float32', 'float64'])
+@pytest.mark.parametrize('out_dtype', ['uint8', 'uint16'])
+def test_cast_with_nodata(in_dtype, out_dtype, numba_mode):
+    from terracotta.handlers import kiyomasa
+
+    data = np.array([[0, 1], [200, 254]], dtype=in_dtype)
+    mask = np.array([[False, True], [False, False]])
+
+    out = kiyomasa.cast_with_nodata(data, mask, np.dtype(out_dtype).type)
+
+    assert out.dtype == out_dtype
+    np.testing.assert_array_equal(out, [[0, np.iinfo(out_dtype).max], [200, 254]])
+
+
+def _reference_int16_to_uint16(tile):
+    out = tile + np.iinfo(np.int16).max
+    out = np.clip(out, 0, np.iinfo(np.uint16).max)
+    out[tile.mask] = np.iinfo(np.uint16).max
+    return out.astype(np.uint16)
+
+
+@pytest.mark.parametrize('dtype', ['int16', 'uint16', 'int8', 'float64'])
+def test_int16_to_uint16(dtype, numba_mode):
+    from terracotta.handlers import kiyomasa
+
+    np.random.seed(17)
+    data = np.random.randint(-40000, 70000, size=(256, 256)).astype(dtype)
+    mask = np.random.rand(256, 256) > 0.8
+
+    out = kiyomasa.int16_to_uint16(data, mask)
+
+    assert out.dtype == np.uint16
+    np.testing.assert_array_equal(
+        out, _reference_int16_to_uint16(np.ma.masked_array(data.astype('float64'), mask=mask))
+    )
+
+
+@pytest.mark.parametrize('dtype,values,expected', [
+    ('int16', [-32768, -32767, 0, 32767], [0, 0, 32767, 65534]),
+    ('uint16', [0, 1, 32768, 40000], [32767, 32768, 65535, 65535]),
+    ('int8', [-128, 0, 100, 127], [32639, 32767, 32867, 32894]),
+    ('float64', [-40000, -32767, 0, 40000], [0, 0, 32767, 65535]),
+])
+def test_int16_to_uint16_limits(dtype, values, expected, numba_mode):
+    from terracotta.handlers import kiyomasa
+
+    data = np.array([values], dtype=dtype)
+    out = kiyomasa.int16_to_uint16(data, np.zeros(data.shape, dtype=bool))
+
+    np.testing.assert_array_equal(out, [expected])
+
+
+def test_get_png_stream_uint16_packing(imagecodecs_mode):
+    from PIL import Image
+    from terracotta.handlers import kiyomasa
+
+    image = np.array([[1, 258], [65535, 0]], dtype='uint16')
+    img = Image.open(kiyomasa.get_png_stream(image))
+
+    assert img.mode == 'LA'
+    np.testing.assert_array_equal(
+        np.asarray(img), [[[1, 0], [2, 1]], [[255, 255], [0, 0]]]
+    )
+
+
+def test_get_png_stream_non_contiguous(imagecodecs_mode):
+    from PIL import Image
+    from terracotta.handlers import kiyomasa
+
+    image = np.arange(64, dtype='uint8').reshape(8, 8)[::2, 1::3]
+    img = Image.open(kiyomasa.get_png_stream(image))
+    assert img.mode == 'L'
+    np.testing.assert_array_equal(np.asarray(img), image)
+
+
+def test_get_png_stream_invalid_dtype():
+    from terracotta.handlers import kiyomasa
+
+    with pytest.raises(ValueError):
+        kiyomasa.get_png_stream(np.zeros((2, 2), dtype='float32'))
+
+
+def test_get_png_stream_compress_level():
+    import terracotta
+    from terracotta.handlers import kiyomasa
+
+    image = np.tile(np.arange(256, dtype='uint8'), (256, 1))
+
+    terracotta.update_settings(PNG_COMPRESS_LEVEL_FAST=0)
+    uncompressed = kiyomasa.get_png_stream(image).read()
+
+    terracotta.update_settings(PNG_COMPRESS_LEVEL_FAST=9)
+    compressed = kiyomasa.get_png_stream(image).read()
+
+    assert len(compressed) < len(uncompressed)
@@ -422,3 +422,161 @@ def test_get_spec(client):
     rv = client.get('/apidoc')
     assert rv.status_code == 200
     assert b'Terracotta' in rv.data
+
+
+@pytest.fixture()
+def fake_kiyomasa_handler(monkeypatch):
+    import terracotta.server.kiyomasa
+    from terracotta.handlers import kiyomasa
+
+    calls = []
+
+    def handler(keys, tile_xyz=None, tile_size=None):
+        calls.append((tuple(keys), tile_xyz, tile_size))
+        return kiyomasa.get_png_stream(np.zeros(tile_size or (256, 256), dtype='uint8'))
+
+    monkeypatch.setitem(terracotta.server.kiyomasa._HANDLERS, 'Pphw10', handler)
+    monkeypatch.setattr(terracotta.server.kiyomasa, '_TILE_CACHE', None)
+    return calls
+
+
+def test_get_kiyomasa(client, fake_kiyomasa_handler):
+    rv = client.get('/kiyomasa/Pphw10/20200101/1/2/10/900/400.png')
+    assert rv.status_code == 200
+
+    assert rv.content_length == len(rv.data)
+    assert rv.cache_control.public
+    assert rv.cache_control.max_age == 300
+    assert 'no-transform' in rv.headers['Cache-Control']
+
+    img = Image.open(BytesIO(rv.data))
+    assert np.asarray(img).shape == (256, 256)
+    assert fake_kiyomasa_handler == [(('Pphw10', '20200101', '1', '2'), (900, 400, 10), None)]
+
+
+def test_get_kiyomasa_cache(client, fake_kiyomasa_handler):
+    for _ in range(2):
+        rv = client.get('/kiyomasa/Pphw10/20200101/1/2/10/900/400.png')
+        assert rv.status_code == 200
+
+    assert len(fake_kiyomasa_handler) == 1
+
+    rv = client.get('/kiyomasa/Pphw10/20200101/1/2/10/901/400.png')
+    assert rv.status_code == 200
+
+    assert len(fake_kiyomasa_handler) == 2
+
+
+def test_get_kiyomasa_cache_expiry(client, fake_kiyomasa_handler):
+    from terracotta import update_settings
+
+    url = '/kiyomasa/Pphw10/20200101/1/2/10/900/400.png'
+
+    update_settings(DRIVER_PATH='other.sqlite')
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert len(fake_kiyomasa_handler) == 1
+
+    update_settings(DRIVER_PATH='another.sqlite')
+    rv = client.get(url)
+    assert len(fake_kiyomasa_handler) == 2
+
+    # tiles are not kept around for longer than clients may cache them
+    update_settings(KIYOMASA_CACHE_MAX_AGE=0)
+    for _ in range(2):
+        rv = client.get(url)
+        assert rv.status_code == 200
+    assert len(fake_kiyomasa_handler) == 4
+
+
+def test_get_kiyomasa_etag(client, fake_kiyomasa_handler):
+    import terracotta.server.kiyomasa
+
+    url = '/kiyomasa/Pphw10/20200101/1/2/10/900/400.png'
+    rv = client.get(url)
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+
+    terracotta.server.kiyomasa._TILE_CACHE.clear()
+
+    rv = client.get(url, headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+    assert rv.headers['ETag'] == etag
+    assert rv.cache_control.max_age == 300
+    assert len(fake_kiyomasa_handler) == 1
+
+    rv = client.get('/kiyomasa/Pphw10/20200101/1/2/10/901/400.png',
+                    headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
+def test_get_kiyomasa_tile_size(client, fake_kiyomasa_handler):
+    rv = client.get('/kiyomasa/Pphw10/20200101/1/2/10/900/400.png?tile_size=[128,64]')
+    assert rv.status_code == 200
+
+    img = Image.open(BytesIO(rv.data))
+    assert np.asarray(img).shape == (128, 64)
+    assert fake_kiyomasa_handler[0][2] == [128, 64]
+
+
+@pytest.mark.parametrize('tile_size', ['[128]', '[128,a]', '[128,1.5]', '128', '{"a":1}'])
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_get_kiyomasa_invalid_tile_size(client, fake_kiyomasa_handler, tile_size, use_orjson,
+                                        monkeypatch):
+    import terracotta.server.kiyomasa
+
+    if use_orjson and not terracotta.server.kiyomasa.has_orjson:
+        pytest.skip('orjson is not installed')
+
+    monkeypatch.setattr(terracotta.server.kiyomasa, 'has_orjson', use_orjson)
+
+    rv = client.get(f'/kiyomasa/Pphw10/20200101/1/2/10/900/400.png?tile_size={tile_size}')
+    assert rv.status_code == 400
+    assert fake_kiyomasa_handler == []
+
+
+def test_get_kiyomasa_batch(client, fake_kiyomasa_handler):
+    import tarfile
+
+    rv = client.get('/kiyomasa/Pphw10/20200101/1/2/10/900/400.png')
+    assert rv.status_code == 200
+
+    rv = client.get('/kiyomasa/Pphw10/20200101/1/2/10/900/400/2/3.tar?tile_size=[16,16]')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/x-tar'
+    assert rv.cache_control.max_age == 300
+    assert 'no-transform' in rv.headers['Cache-Control']
+
+    with tarfile.open(fileobj=BytesIO(rv.data)) as tar:
+        names = tar.getnames()
+        img = Image.open(tar.extractfile('10/901/402.png'))
+
+    assert names == [f'10/{x}/{y}.png' for x in (900, 901) for y in (400, 401, 402)]
+    assert np.asarray(img).shape == (16, 16)
+    assert len(fake_kiyomasa_handler) == 7
+
+    # tiles of a batch end up in the same cache as single tiles
+    rv = client.get('/kiyomasa/Pphw10/20200101/1/2/10/901/401.png?tile_size=[16,16]')
+    assert rv.status_code == 200
+    assert len(fake_kiyomasa_handler) == 7
+
+
+@pytest.mark.parametrize('size', ['0/1', '1/0', '8/9'])
+def test_get_kiyomasa_batch_invalid_size(client, fake_kiyomasa_handler, size):
+    rv = client.get(f'/kiyomasa/Pphw10/20200101/1/2/10/900/400/{size}.tar')
+    assert rv.status_code == 400
+    assert fake_kiyomasa_handler == []
+
+
+@pytest.mark.parametrize('kind', ['UNKNOWN', 'get_png_stream', 'np'])
+def test_get_kiyomasa_unknown_kind(client, kind):
+    for url in (f'/kiyomasa/{kind}/20200101/1/2/10/900/400.png',
+                f'/kiyomasa/{kind}/20200101/1/2/10/900/400/2/2.tar'):
+        rv = client.get(url)
+        assert rv.status_code == 404
+        assert kind in rv.get_json()['message']
+        assert rv.cache_control.public
+        assert rv.cache_control.max_age == 60
+        assert 'no-transform' in rv.headers['Cache-Control']
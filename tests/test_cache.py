@@ -10,3 +10,22 @@ def test_get_size():
     mask = zlib.compress(np.zeros(tile_shape), 9)
     size = CompressedLFUCache._get_size((data, mask, 'float64', tile_shape))
     assert 1450 < size < 1550
+
+
+def test_closing_lru_cache():
+    from terracotta.cache import ClosingLRUCache
+
+    class Handle:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    handles = [Handle() for _ in range(3)]
+    cache = ClosingLRUCache(2)
+    for i, handle in enumerate(handles):
+        cache[i] = handle
+
+    assert handles[0].closed
+    assert not any(handle.closed for handle in handles[1:])
+    assert list(cache.keys()) == [1, 2]
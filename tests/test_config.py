@@ -44,6 +44,11 @@ def test_env_config_invalid(monkeypatch):
         with pytest.raises(ValueError):
             config.parse_config()
 
+    with monkeypatch.context() as m:
+        m.setenv('TC_CPROFILE_DIR', '/tmp/does_not_exist_dir')  # non-existing folder
+        with pytest.raises(ValueError):
+            config.parse_config()
+
     assert True
 
 
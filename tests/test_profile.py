@@ -45,3 +45,40 @@ def test_xray_exception(caplog):
 
     assert len(subsegment.cause['exceptions']) == 1
     assert subsegment.cause['exceptions'][0].message == 'foo'
+
+
+def test_profile_request(tmpdir):
+    import pstats
+    from terracotta import update_settings
+    import terracotta.profile
+
+    @terracotta.profile.profile_request('dummy')
+    def func_to_profile(value):
+        return value * 2
+
+    assert func_to_profile(2) == 4
+    assert not tmpdir.listdir()
+
+    update_settings(CPROFILE_DIR=str(tmpdir))
+    assert func_to_profile(3) == 6
+
+    outfiles = tmpdir.listdir()
+    assert len(outfiles) == 1
+    assert outfiles[0].basename.startswith('dummy-')
+    assert outfiles[0].ext == '.prof'
+    pstats.Stats(str(outfiles[0]))
+
+
+def test_profile_request_unwritable(tmpdir, caplog):
+    from terracotta import update_settings
+    import terracotta.profile
+
+    @terracotta.profile.profile_request('dummy')
+    def func_to_profile():
+        return 'result'
+
+    update_settings(CPROFILE_DIR=str(tmpdir))
+    tmpdir.remove()
+
+    assert func_to_profile() == 'result'
+    assert any('profile stats' in record.getMessage() for record in caplog.records)